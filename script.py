@@ -22,11 +22,11 @@ Author: Venky10D"""
 
 
 
-import clr, sys, os, math, re
+import clr, sys, os, math, re, bisect, heapq
 from Autodesk.Revit.DB import (
     ImportInstance, Options, GeometryElement, GeometryInstance,
     Line, Arc, PolyLine, Mesh, Solid, Family, FamilySymbol, BuiltInCategory,
-    BuiltInParameter, FilteredElementCollector, Level, XYZ, Transaction, Wall,
+    BuiltInParameter, ElementId, FilteredElementCollector, Level, XYZ, Transaction, Wall,
     WallType, WallKind, WallUtils, JoinGeometryUtils, ElementTransformUtils)
 from Autodesk.Revit.UI import TaskDialog
 from Autodesk.Revit.UI.Selection import ObjectType, ISelectionFilter
@@ -38,7 +38,10 @@ clr.AddReference("PresentationCore")
 clr.AddReference("WindowsBase")
 clr.AddReference("System.Windows.Forms")
 import System.Windows.Forms as WinForms
+from System import Predicate
+from System.Collections.Generic import List
 from System.Windows import Window, Thickness
+from System.Windows.Data import CollectionViewSource
 from System.Windows.Markup import XamlReader
 import System.Windows.Controls
 
@@ -54,6 +57,11 @@ COLOR_BG = "#FFFFFF"
 COLOR_BORDER = "#35ADB8"
 COLOR_ACCENT = "#35ADB8"
 COLOR_TEXT = "#000000"
+_DIGIT_RE = re.compile(r'\d+')
+MERGE_COS_TOL = math.cos(0.1)
+HALF_PI = math.pi / 2
+# Folded-angle span that keeps structural faces at |cos| >= 0.99
+PARALLEL_ANGLE_TOL = math.acos(0.99)
 
 
 class CADFileSelectionFilter(ISelectionFilter):
@@ -70,23 +78,114 @@ try:
 except Exception:
     sys.exit()
 
-cadFileName = selected_cad_link.Name
+cad_category = selected_cad_link.Category
+cad_file_name = cad_category.Name if cad_category else "Unknown CAD File"
 
 
-def get_layer_names(cad_link):
+def get_layer_names(cat):
     names = set()
-    cat = cad_link.Category
     if cat and cat.SubCategories:
         for sub in cat.SubCategories:
             names.add(sub.Name)
     return sorted(names)
 
 
-all_layers = get_layer_names(selected_cad_link)
+all_layers = get_layer_names(cad_category)
 if not all_layers:
     sys.exit()
 
 
+def symbol_key(instance):
+    # Prefer the id of the symbol geometry itself (Revit 2023+). Otherwise use
+    # the symbol's element id. None sends the instance down the uncached
+    # GetInstanceGeometry() path.
+    try:
+        return instance.GetSymbolGeometryId().AsUniqueIdentifier()
+    except Exception:
+        pass
+    try:
+        sym_id = instance.Symbol.Id
+    except Exception:
+        return None
+    if sym_id is None or sym_id == ElementId.InvalidElementId:
+        return None
+    return sym_id
+
+
+def transform_element(element, transform):
+    moved = dict(element)
+    for key in ('start', 'end'):
+        if moved.get(key) is not None:
+            moved[key] = transform.OfPoint(moved[key])
+    if 'points' in moved:
+        moved['points'] = [transform.OfPoint(p) for p in moved['points']]
+    return moved
+
+
+def _h_mline(geom, out):
+    out.append({
+        'start': geom.GetEndPoint(0) if hasattr(geom, "GetEndPoint") else None,
+        'end': geom.GetEndPoint(1) if hasattr(geom, "GetEndPoint") else None,
+        'type': 'MLine'
+    })
+
+
+def _h_line(geom, out):
+    out.append({
+        'start': geom.GetEndPoint(0),
+        'end': geom.GetEndPoint(1),
+        'type': 'Line'
+    })
+
+
+def _h_arc(geom, out):
+    out.append({
+        'start': geom.GetEndPoint(0),
+        'end': geom.GetEndPoint(1),
+        'type': 'Arc'
+    })
+
+
+def _h_poly(geom, out):
+    pts = geom.GetCoordinates()
+    out.append({'points': pts, 'type': 'PolyLine'})
+
+
+def _h_mesh(geom, out):
+    for i in range(geom.NumTriangles):
+        tri = geom.get_Triangle(i)
+        verts = [tri.get_Vertex(j) for j in range(3)]
+        for j in range(3):
+            out.append({
+                'start': verts[j],
+                'end': verts[(j + 1) % 3],
+                'type': 'Mesh Edge'
+            })
+
+
+def _h_solid(geom, out):
+    # Solid.Edges lists each edge once, not once per adjacent face
+    for edge in geom.Edges:
+        curve = edge.AsCurve()
+        out.append({
+            'start': curve.GetEndPoint(0),
+            'end': curve.GetEndPoint(1),
+            'type': 'Solid Edge'
+        })
+
+
+# Leaf handlers keyed by the lowercased .NET type name of the geometry
+_HANDLERS = {
+    'line': _h_line,
+    'arc': _h_arc,
+    'polyline': _h_poly,
+    'mesh': _h_mesh,
+    'solid': _h_solid,
+    'mline': _h_mline,
+    'multiline': _h_mline,
+}
+
+
 def get_elements_coordinates_by_layer(doc, selected_layer, cad_link):
     if not doc or not cad_link:
         return ([], [])
@@ -98,68 +197,34 @@ def get_elements_coordinates_by_layer(doc, selected_layer, cad_link):
         return ([], [])
     elements = []
     blocks = []
+    selected_layer_lc = selected_layer.lower()
+    layer_cache = {}
+    symbol_cache = {}
+
+    def is_target_layer(gs_id):
+        # ElementId hashes and compares by value, so it keys the cache directly
+        hit = layer_cache.get(gs_id)
+        if hit is None:
+            gs = doc.GetElement(gs_id)
+            hit = bool(gs and gs.GraphicsStyleCategory and
+                       gs.GraphicsStyleCategory.Name.lower() == selected_layer_lc)
+            layer_cache[gs_id] = hit
+        return hit
 
-    def extract(geom):
-        try:
-            for sub_geom in geom:
-                extract(sub_geom)
-            return
-        except TypeError:
-            pass
-        if isinstance(geom, GeometryInstance):
-            blocks.append(geom)
-            instance_geom = geom.GetInstanceGeometry()
-            if instance_geom:
-                extract(instance_geom)
-            return
+    def extract(geom, out):
         gs_id = getattr(geom, "GraphicsStyleId", None)
         if gs_id:
-            gs = doc.GetElement(gs_id)
-            if gs and gs.GraphicsStyleCategory and gs.GraphicsStyleCategory.Name.lower() == selected_layer.lower():
-                geom_type = geom.GetType().Name.lower()
-                if geom_type in ["mline", "multiline"]:
-                    elements.append({
-                        'start': geom.GetEndPoint(0) if hasattr(geom, "GetEndPoint") else None,
-                        'end': geom.GetEndPoint(1) if hasattr(geom, "GetEndPoint") else None,
-                        'type': 'MLine'
-                    })
-                elif geom_type == "line" or isinstance(geom, Line):
-                    elements.append({
-                        'start': geom.GetEndPoint(0),
-                        'end': geom.GetEndPoint(1),
-                        'type': 'Line'
-                    })
-                elif geom_type == "arc" or isinstance(geom, Arc):
-                    elements.append({
-                        'start': geom.GetEndPoint(0),
-                        'end': geom.GetEndPoint(1),
-                        'type': 'Arc'
-                    })
-                elif geom_type == "polyline" or isinstance(geom, PolyLine):
-                    pts = geom.GetCoordinates()
-                    elements.append({'points': pts, 'type': 'PolyLine'})
-                elif isinstance(geom, Mesh):
-                    for face in geom.Faces:
-                        verts = face.GetVertices()
-                        for i in range(len(verts) - 1):
-                            elements.append({
-                                'start': verts[i],
-                                'end': verts[i + 1],
-                                'type': 'Mesh Edge'
-                            })
-                elif isinstance(geom, Solid):
-                    for face in geom.Faces:
-                        verts = geom.Faces[0].GetVertices()
-                        for i in range(len(verts) - 1):
-                            elements.append({
-                                'start': verts[i],
-                                'end': verts[i + 1],
-                                'type': 'Solid Edge'
-                            })
+            if is_target_layer(gs_id):
+                handler = _HANDLERS.get(geom.GetType().Name.lower())
+                if handler:
+                    try:
+                        handler(geom, out)
+                    except Exception:
+                        pass
         else:
             if hasattr(geom, "GetEndPoint"):
                 try:
-                    elements.append({
+                    out.append({
                         'start': geom.GetEndPoint(0),
                         'end': geom.GetEndPoint(1),
                         'type': geom.GetType().Name
@@ -167,7 +232,38 @@ def get_elements_coordinates_by_layer(doc, selected_layer, cad_link):
                 except Exception:
                     pass
 
-    extract(geom_elem)
+    def walk(root, out):
+        stack = [root]
+        while stack:
+            geom = stack.pop()
+            if isinstance(geom, (list, tuple, GeometryElement)):
+                # Push children reversed so they are visited in their original order
+                stack.extend(reversed(list(geom)))
+            elif isinstance(geom, GeometryInstance):
+                blocks.append(geom)
+                sym_key = symbol_key(geom)
+                if sym_key is None:
+                    instance_geom = geom.GetInstanceGeometry()
+                    if instance_geom:
+                        stack.append(instance_geom)
+                    continue
+                # Repeated blocks share one walk of their symbol geometry; only
+                # the instance transform is applied per reference.
+                if sym_key not in symbol_cache:
+                    symbol_elements = []
+                    symbol_geom = geom.GetSymbolGeometry()
+                    if symbol_geom:
+                        walk(symbol_geom, symbol_elements)
+                    symbol_cache[sym_key] = symbol_elements
+                transform = geom.Transform
+                if transform.IsIdentity:
+                    out.extend(symbol_cache[sym_key])
+                else:
+                    out.extend(transform_element(e, transform) for e in symbol_cache[sym_key])
+            else:
+                extract(geom, out)
+
+    walk(geom_elem, elements)
     return (elements, blocks)
 
 
@@ -184,10 +280,17 @@ def get_wall_type_display_name(wt):
     return "{0} - {1}".format(getattr(wt, "FamilyName", "System Wall"), getattr(wt, "Name", "Unnamed"))
 
 
-wall_names = sorted(set(get_wall_type_display_name(wt) for wt in basic_wall_types))
+_wt_by_display = {}
+for wt in basic_wall_types:
+    _wt_by_display.setdefault(get_wall_type_display_name(wt), wt)
+wall_names = sorted(_wt_by_display.keys())
 
 levels = sorted(FilteredElementCollector(doc).OfClass(Level).ToElements(), key=lambda lvl: lvl.Elevation)
 level_names = [lvl.Name for lvl in levels]
+_level_by_name = {}
+for lvl in levels:
+    _level_by_name.setdefault(lvl.Name, lvl)
+_lvl_elev = {name: lvl.Elevation for name, lvl in _level_by_name.items()}
 try:
     active_level_name = doc.ActiveView.GenLevel.Name
 except Exception:
@@ -203,52 +306,251 @@ bottom_default = levels[active_index - 1] if active_index > 0 else levels[active
 
 
 def find_family_symbol(wall_fam):
-    for wt in basic_wall_types:
-        if get_wall_type_display_name(wt) == wall_fam:
-            return wt
-    return None
+    return _wt_by_display.get(wall_fam)
 
 
 def find_level_by_name(name):
-    for lvl in levels:
-        if lvl.Name == name:
-            return lvl
-    return None
+    return _level_by_name.get(name)
 
 
-def segment_direction(p1, p2):
-    dx = p2.X - p1.X
-    dy = p2.Y - p1.Y
-    mag = math.sqrt(dx * dx + dy * dy)
-    if mag < 1e-9:
-        return (0, 0)
-    return (dx / mag, dy / mag)
+def polyline_coords(pts):
+    return [(p.X, p.Y, p.Z) for p in pts]
+
+
+def polyline_segments(coords):
+    xs = [c[0] for c in coords]
+    ys = [c[1] for c in coords]
+    dxs = [xs[i + 1] - xs[i] for i in range(len(xs) - 1)]
+    dys = [ys[i + 1] - ys[i] for i in range(len(ys) - 1)]
+    lengths = [math.sqrt(dx * dx + dy * dy) for dx, dy in zip(dxs, dys)]
+    dirs = [(dx / mag, dy / mag) if mag >= 1e-9 else (0, 0) for dx, dy, mag in zip(dxs, dys, lengths)]
+    return dxs, dys, lengths, dirs
+
+
+def make_segment(p_start, p_end, dx, dy):
+    # p_start / p_end are (x, y, z) tuples, not XYZ
+    length = math.sqrt(dx * dx + dy * dy)
+    return {
+        'start': p_start,
+        'end': p_end,
+        'direction': (dx / length, dy / length) if length >= 1e-9 else (0, 0),
+        'length': length,
+        'used': False  # Track if segment has been used
+    }
 
 
 def snap_angle(angle, tol=0.01):
-    cardinals = [0, math.pi / 2, math.pi, 3 * math.pi / 2]
-    mod_angle = angle % (2 * math.pi)
-    for c in cardinals:
-        if abs(mod_angle - c) < tol:
-            return c
+    k = int(round(angle / HALF_PI))
+    snapped = k * HALF_PI
+    if abs(angle - snapped) < tol:
+        return (k % 4) * HALF_PI
     return angle
 
 
-def wall_exists(candidate_line, tol=0.005):
-    existing_walls = FilteredElementCollector(doc).OfClass(Wall).ToElements()
-    for wall in existing_walls:
+def match_structural_pair(seg1, seg2, width_to_family):
+    # Segments are (start, end, direction, length) with (x, y, z) tuple endpoints
+    d1 = seg1[2]
+    d2 = seg2[2]
+    if abs(d1[0] * d2[0] + d1[1] * d2[1]) < 0.99:
+        return None
+    diff_x = seg1[0][0] - seg2[0][0]
+    diff_y = seg1[0][1] - seg2[0][1]
+    perp_dot = abs(diff_x * (-d2[1]) + diff_y * d2[0])
+    distance_ft = perp_dot
+    distance_mm_int = int(round(distance_ft * 304.8, 0))
+    proj1 = seg1[0][0] * d1[0] + seg1[0][1] * d1[1]
+    proj2 = seg1[1][0] * d1[0] + seg1[1][1] * d1[1]
+    seg1_min = min(proj1, proj2)
+    seg1_max = max(proj1, proj2)
+    projB1 = seg2[0][0] * d1[0] + seg2[0][1] * d1[1]
+    projB2 = seg2[1][0] * d1[0] + seg2[1][1] * d1[1]
+    seg2_min = min(projB1, projB2)
+    seg2_max = max(projB1, projB2)
+    overlap_start = max(seg1_min, seg2_min)
+    overlap_end = min(seg1_max, seg2_max)
+    overlap_length = overlap_end - overlap_start
+    if overlap_length <= 0:
+        return None
+    wall_fam = match_family_width(width_to_family, distance_mm_int)
+    if wall_fam is None:
+        return None
+    mid_proj = (overlap_start + overlap_end) / 2.0
+    dot_p1 = seg1[0][0] * d1[0] + seg1[0][1] * d1[1]
+    offset1 = mid_proj - dot_p1
+    p1x = seg1[0][0] + d1[0] * offset1
+    p1y = seg1[0][1] + d1[1] * offset1
+    dot_p2 = seg2[0][0] * d1[0] + seg2[0][1] * d1[1]
+    offset2 = mid_proj - dot_p2
+    p2x = seg2[0][0] + d1[0] * offset2
+    p2y = seg2[0][1] + d1[1] * offset2
+    mx = (p1x + p2x) / 2.0
+    my = (p1y + p2y) / 2.0
+    mz = (seg1[0][2] + seg2[0][2]) / 2.0
+    angle = math.atan2(d1[1], d1[0])
+    angle = snap_angle(angle, tol=0.01)
+    return (mx, my, mz, angle, overlap_length, wall_fam)
+
+
+def group_by_angle(angles, tol):
+    # angles are folded into [0, pi). Each angle joins the earliest-created
+    # group whose anchor (its first angle in input order) lies within tol on
+    # either side, wrapping at pi; otherwise it anchors a new group. Only the
+    # anchor is compared, never the other members, so groups do not chain.
+    # Anchors are therefore at least tol apart and at most the two nearest
+    # sorted anchors can match. Groups are returned in creation order.
+    anchors = []
+    anchor_groups = []
+    groups = []
+    for k, angle in enumerate(angles):
+        best = None
+        if anchors:
+            i = bisect.bisect_left(anchors, angle)
+            for j in (i - 1, i % len(anchors)):
+                diff = abs(anchors[j] - angle)
+                if min(diff, math.pi - diff) < tol:
+                    if best is None or anchor_groups[j] < best:
+                        best = anchor_groups[j]
+        if best is None:
+            i = bisect.bisect_left(anchors, angle)
+            anchors.insert(i, angle)
+            anchor_groups.insert(i, len(groups))
+            groups.append([k])
+        else:
+            groups[best].append(k)
+    return groups
+
+
+def parallel_pair_midpoint(lx0, ly0, lz0, lx1, ly1, lz1, sx, sy, sz, dx, dy):
+    # Midpoint between the longer segment's centre and its projection onto the
+    # shorter segment's line, plus the perpendicular distance between the lines.
+    # (dx, dy) is the pair's unit direction; plain floats keep XYZ out of the loop.
+    lmx = (lx0 + lx1) / 2
+    lmy = (ly0 + ly1) / 2
+    lmz = (lz0 + lz1) / 2
+    dir_dot = (lmx - sx) * dx + (lmy - sy) * dy
+    px = sx + dir_dot * dx
+    py = sy + dir_dot * dy
+    distance = abs((lmx - px) * -dy + (lmy - py) * dx)
+    return ((lmx + px) / 2, (lmy + py) / 2, (lmz + sz) / 2, distance)
+
+
+def pair_candidates(segs, min_width_mm, max_width_mm):
+    # For each segment i, the later segments (ascending index) whose offset
+    # along the group's reference normal could put them a family width away.
+    # slack bounds the error of measuring on one normal between midpoints
+    # when the group's segments are not exactly parallel.
+    ref = segs[0]['direction']
+    nx, ny = -ref[1], ref[0]
+    offsets = [nx * (s['start'][0] + s['end'][0]) / 2 + ny * (s['start'][1] + s['end'][1]) / 2 for s in segs]
+    sin_max = max(abs(ref[0] * s['direction'][1] - ref[1] * s['direction'][0]) for s in segs)
+    xs = [p[0] for s in segs for p in (s['start'], s['end'])]
+    ys = [p[1] for s in segs for p in (s['start'], s['end'])]
+    slack = 3 * sin_max * math.sqrt((max(xs) - min(xs)) ** 2 + (max(ys) - min(ys)) ** 2)
+    lo = max(0.0, (min_width_mm - 0.5) / 304.8 - slack)
+    hi = (max_width_mm + 0.5) / 304.8 + slack
+    by_offset = sorted(range(len(segs)), key=offsets.__getitem__)
+    sorted_offsets = [offsets[k] for k in by_offset]
+    candidates = []
+    for i, o in enumerate(offsets):
+        below = by_offset[bisect.bisect_left(sorted_offsets, o - hi):bisect.bisect_right(sorted_offsets, o - lo)]
+        above = by_offset[bisect.bisect_left(sorted_offsets, o + lo):bisect.bisect_right(sorted_offsets, o + hi)]
+        candidates.append(sorted(set(k for k in below + above if k > i)))
+    return candidates
+
+
+def _d2(ax, ay, az, bx, by, bz):
+    dx = ax - bx
+    dy = ay - by
+    dz = az - bz
+    return dx * dx + dy * dy + dz * dz
+
+
+def grid_cell(x, y, cell):
+    return (int(math.floor(x / cell)), int(math.floor(y / cell)))
+
+
+def grid_add(grid, x, y, z, item, cell=0.01):
+    grid.setdefault(grid_cell(x, y, cell), []).append((x, y, z, item))
+
+
+def grid_near(grid, x, y, cell=0.01):
+    # Anything within one cell size of (x, y) lies in the surrounding 3x3 cells
+    cx, cy = grid_cell(x, y, cell)
+    for i in (cx - 1, cx, cx + 1):
+        for j in (cy - 1, cy, cy + 1):
+            for entry in grid.get((i, j), ()):
+                yield entry
+
+
+def grid_has_point(grid, x, y, z, tol=0.01, cell=0.01):
+    tol2 = tol * tol
+    for ex, ey, ez, _ in grid_near(grid, x, y, cell):
+        if _d2(ex, ey, ez, x, y, z) < tol2:
+            return True
+    return False
+
+
+# Existing and newly placed walls, bucketed by location-line midpoint. Two
+# lines whose endpoints are each within tol have midpoints within tol too,
+# so the 3x3 cells around a midpoint cover every possible match (tol <= cell).
+_existing_wall_index = {}
+WALL_INDEX_CELL = 0.01
+
+
+def add_wall_endpoints(curve):
+    a = curve.GetEndPoint(0)
+    b = curve.GetEndPoint(1)
+    grid_add(_existing_wall_index, (a.X + b.X) / 2, (a.Y + b.Y) / 2, (a.Z + b.Z) / 2,
+             (a.X, a.Y, a.Z, b.X, b.Y, b.Z), cell=WALL_INDEX_CELL)
+
+
+def index_existing_walls():
+    _existing_wall_index.clear()
+    for wall in FilteredElementCollector(doc).OfClass(Wall).WhereElementIsNotElementType():
         try:
-            locCurve = wall.Location.Curve
-            if ((candidate_line.GetEndPoint(0).DistanceTo(locCurve.GetEndPoint(0)) < tol and
-                 candidate_line.GetEndPoint(1).DistanceTo(locCurve.GetEndPoint(1)) < tol) or
-                    (candidate_line.GetEndPoint(0).DistanceTo(locCurve.GetEndPoint(1)) < tol and
-                     candidate_line.GetEndPoint(1).DistanceTo(locCurve.GetEndPoint(0)) < tol)):
-                return True
+            add_wall_endpoints(wall.Location.Curve)
         except:
             continue
+
+
+def wall_exists(candidate_line, tol=0.005):
+    a = candidate_line.GetEndPoint(0)
+    b = candidate_line.GetEndPoint(1)
+    ax, ay, az, bx, by, bz = a.X, a.Y, a.Z, b.X, b.Y, b.Z
+    tol2 = tol * tol
+    for _, _, _, (p0x, p0y, p0z, p1x, p1y, p1z) in grid_near(_existing_wall_index, (ax + bx) / 2, (ay + by) / 2,
+                                                               cell=WALL_INDEX_CELL):
+        if _d2(ax, ay, az, p0x, p0y, p0z) < tol2 and _d2(bx, by, bz, p1x, p1y, p1z) < tol2:
+            return True
+        if _d2(ax, ay, az, p1x, p1y, p1z) < tol2 and _d2(bx, by, bz, p0x, p0y, p0z) < tol2:
+            return True
     return False
 
 
+def get_family_width(wall_fam):
+    for x in _DIGIT_RE.findall(wall_fam):
+        width = int(x)
+        if width > 10:
+            return width
+    return None
+
+
+def family_width_map(families):
+    # First selected family wins when two share a width, like the old scan
+    width_to_family = {}
+    for fam in families:
+        width = get_family_width(fam)
+        if width is not None:
+            width_to_family.setdefault(width, fam)
+    return width_to_family
+
+
+def match_family_width(width_to_family, width_mm, default_fam=None):
+    # Widths and measured distances are whole millimetres, so the 0.5 mm
+    # tolerance only ever accepts an exact match.
+    return width_to_family.get(width_mm, default_fam)
+
+
 def attach_dropdown_open(combo):
     def open_dropdown(sender, e):
         sender.IsDropDownOpen = True
@@ -257,23 +559,36 @@ def attach_dropdown_open(combo):
     combo.GotFocus += open_dropdown
 
 
+# Lowercased item names, and the last filter text applied to each combo
+_lower_names = {}
+_last_filter_text = {}
+
+
+def set_combo_items(combo, names):
+    # Each combo gets its own list so their default views filter independently
+    for name in names:
+        if name not in _lower_names:
+            _lower_names[name] = name.lower()
+    _last_filter_text.pop(combo, None)
+    combo.ItemsSource = List[str](names)
+
+
+def apply_prefix_filter(combo, txt):
+    # Assigning Filter refreshes the whole view, so skip it when the text
+    # (e.g. only surrounding whitespace) has not changed
+    if _last_filter_text.get(combo) != txt:
+        _last_filter_text[combo] = txt
+        view = CollectionViewSource.GetDefaultView(combo.ItemsSource)
+        view.Filter = Predicate[object](lambda item: _lower_names[item].startswith(txt))
+    combo.IsDropDownOpen = True
+
+
 def filter_wall_family_items(combo):
     edt = combo.Template.FindName("PART_EditableTextBox", combo)
     if edt is None:
         return
-    txt = edt.Text.strip().lower()
-    combo.Items.Clear()
-    for fam in wall_names:
-        if fam.lower().startswith(txt):
-            combo.Items.Add(fam)
-    combo.IsDropDownOpen = True
-
+    apply_prefix_filter(combo, edt.Text.strip().lower())
 
-selected_cad_link = doc.GetElement(selected_ref)
-if selected_cad_link.Category:
-    cad_file_name = selected_cad_link.Category.Name
-else:
-    cad_file_name = "Unknown CAD File"
 
 xaml_str = """
 <Window xmlns="http://schemas.microsoft.com/winfx/2006/xaml/presentation"
@@ -390,14 +705,11 @@ if cad_file_text_block is not None:
     cad_file_text_block.Text = cad_file_name
 
 layer_combo = window.FindName("LayerComboBox")
-for layer in all_layers:
-    layer_combo.Items.Add(layer)
+set_combo_items(layer_combo, all_layers)
 attach_dropdown_open(layer_combo)
 
 wall_family_combo = window.FindName("WallFamilyComboBox")
-wall_family_combo.Items.Clear()
-for fam in wall_names:
-    wall_family_combo.Items.Add(fam)
+set_combo_items(wall_family_combo, wall_names)
 attach_dropdown_open(wall_family_combo)
 wall_family_combo.ApplyTemplate()
 edt_wall = wall_family_combo.Template.FindName("PART_EditableTextBox", wall_family_combo)
@@ -429,12 +741,7 @@ def filter_combo_items():
     edt = layer_combo.Template.FindName("PART_EditableTextBox", layer_combo)
     if edt is None:
         return
-    txt = edt.Text
-    layer_combo.Items.Clear()
-    for layer in all_layers:
-        if layer.lower().startswith(txt.lower()):
-            layer_combo.Items.Add(layer)
-    layer_combo.IsDropDownOpen = True
+    apply_prefix_filter(layer_combo, edt.Text.lower())
 
 
 def on_layer_text_changed(sender, e):
@@ -459,9 +766,7 @@ def on_add_new_family_click(sender, e):
     new_combo.Foreground = wall_family_combo.Foreground
     new_combo.Background = wall_family_combo.Background
     new_combo.Margin = Thickness(0, 5, 0, 0)
-    new_combo.Items.Clear()
-    for fam in wall_names:
-        new_combo.Items.Add(fam)
+    set_combo_items(new_combo, wall_names)
     attach_dropdown_open(new_combo)
     new_combo.ApplyTemplate()
     if new_combo.Template is not None:
@@ -531,11 +836,22 @@ def on_ok_button_click(sender, e):
     except Exception:
         top_offset = 0
 
+    width_to_family = family_width_map(selected_families)
+    min_width_mm = min(width_to_family) if width_to_family else 0
+    max_width_mm = max(width_to_family) if width_to_family else 0
+
     structural_mode = window.FindName("StructuralWallCheckBox").IsChecked
     architectural_mode = window.FindName("ArchitecturalWallCheckBox").IsChecked
 
     lines_data, blocks_data = get_elements_coordinates_by_layer(doc, str(sel_layer), selected_cad_link)
+    # Placements are (mx, my, mz, angle, length, wall_fam); the midpoint stays
+    # as floats until the wall line is built.
     placements = []
+    placement_grid = {}
+
+    def add_placement(placement):
+        placements.append(placement)
+        grid_add(placement_grid, placement[0], placement[1], placement[2], placement)
 
     if structural_mode:
         # Structural mode: use full collinearity or overlapping logic (as before)
@@ -550,80 +866,56 @@ def on_ok_button_click(sender, e):
                     continue
             if len(pts) < 2:
                 continue
-            base_dir = segment_direction(pts[0], pts[1])
+            coords = polyline_coords(pts)
+            seg_dxs, seg_dys, seg_lengths, seg_dirs = polyline_segments(coords)
+            base_dir = seg_dirs[0]
             collinear = True
-            for i in range(1, len(pts) - 1):
-                d = segment_direction(pts[i], pts[i + 1])
-                if abs(base_dir[0] * d[0] + base_dir[1] * d[1]) < 0.99:
+            dx0 = seg_dxs[0]
+            dy0 = seg_dys[0]
+            sq0 = dx0 * dx0 + dy0 * dy0
+            for i in range(1, len(seg_dxs)):
+                dx = seg_dxs[i]
+                dy = seg_dys[i]
+                sq = dx * dx + dy * dy
+                dot = dx0 * dx + dy0 * dy
+                # |cos| < 0.99 without normalizing either segment
+                if sq0 < 1e-18 or sq < 1e-18 or dot * dot < 0.9801 * sq0 * sq:
                     collinear = False
                     break
             if collinear:
-                full_length = math.sqrt((pts[-1].X - pts[0].X) ** 2 + (pts[-1].Y - pts[0].Y) ** 2)
-                mid_point = XYZ((pts[0].X + pts[-1].X) / 2.0, (pts[0].Y + pts[-1].Y) / 2.0,
-                                (pts[0].Z + pts[-1].Z) / 2.0)
+                first, last = coords[0], coords[-1]
+                full_length = math.sqrt((last[0] - first[0]) ** 2 + (last[1] - first[1]) ** 2)
+                mx = (first[0] + last[0]) / 2.0
+                my = (first[1] + last[1]) / 2.0
+                mz = (first[2] + last[2]) / 2.0
                 angle = math.atan2(base_dir[1], base_dir[0])
                 angle = snap_angle(angle, tol=0.01)
-                for wall_fam in selected_families:
-                    placements.append((mid_point, angle, full_length, wall_fam))
-                    break
+                if selected_families:
+                    add_placement((mx, my, mz, angle, full_length, selected_families[0]))
             else:
-                segments = []
-                for i in range(len(pts) - 1):
-                    p_start = pts[i]
-                    p_end = pts[i + 1]
-                    d = segment_direction(p_start, p_end)
-                    seg_length = math.sqrt((p_end.X - p_start.X) ** 2 + (p_end.Y - p_start.Y) ** 2)
-                    segments.append((p_start, p_end, d, seg_length))
+                segments = [(coords[i], coords[i + 1], seg_dirs[i], seg_lengths[i])
+                            for i in range(len(seg_dirs))]
                 if len(segments) < 2:
                     continue
-                segments.sort(key=lambda s: s[3], reverse=True)
-                seg1 = segments[0]
-                seg2 = segments[1]
+                # The two longest segments overall are the faces, as before
+                seg1, seg2 = heapq.nlargest(2, segments, key=lambda s: s[3])
                 d1 = seg1[2]
                 d2 = seg2[2]
-                if abs(d1[0] * d2[0] + d1[1] * d2[1]) < 0.99:
+                if abs(d1[0] * d2[0] + d1[1] * d2[1]) >= 0.99:
+                    candidate_data = match_structural_pair(seg1, seg2, width_to_family)
+                    if candidate_data:
+                        add_placement(candidate_data)
                     continue
-                diff_x = seg1[0].X - seg2[0].X
-                diff_y = seg1[0].Y - seg2[0].Y
-                perp_dot = abs(diff_x * (-d2[1]) + diff_y * d2[0])
-                distance_ft = perp_dot
-                distance_mm_int = int(round(distance_ft * 304.8, 0))
-                proj1 = seg1[0].X * d1[0] + seg1[0].Y * d1[1]
-                proj2 = seg1[1].X * d1[0] + seg1[1].Y * d1[1]
-                seg1_min = min(proj1, proj2)
-                seg1_max = max(proj1, proj2)
-                projB1 = seg2[0].X * d1[0] + seg2[0].Y * d1[1]
-                projB2 = seg2[1].X * d1[0] + seg2[1].Y * d1[1]
-                seg2_min = min(projB1, projB2)
-                seg2_max = max(projB1, projB2)
-                overlap_start = max(seg1_min, seg2_min)
-                overlap_end = min(seg1_max, seg2_max)
-                overlap_length = overlap_end - overlap_start
-                if overlap_length <= 0:
-                    continue
-                candidate_data = None
-                for wall_fam in selected_families:
-                    extracted_ints = [int(x) for x in re.findall(r'\d+', wall_fam) if int(x) > 10]
-                    if not extracted_ints:
+                # Otherwise pair the two longest segments of each parallel group
+                segments = [seg for seg in segments if seg[3] >= 1e-9]
+                seg_angles = [math.atan2(seg[2][1], seg[2][0]) % math.pi for seg in segments]
+                for group in group_by_angle(seg_angles, PARALLEL_ANGLE_TOL):
+                    if len(group) < 2:
                         continue
-                    desired_width = extracted_ints[0]
-                    if (desired_width - 0.5) <= distance_mm_int <= (desired_width + 0.5):
-                        mid_proj = (overlap_start + overlap_end) / 2.0
-                        dot_p1 = seg1[0].X * d1[0] + seg1[0].Y * d1[1]
-                        offset1 = mid_proj - dot_p1
-                        point_on_line1 = XYZ(seg1[0].X + d1[0] * offset1, seg1[0].Y + d1[1] * offset1, seg1[0].Z)
-                        dot_p2 = seg2[0].X * d1[0] + seg2[0].Y * d1[1]
-                        offset2 = mid_proj - dot_p2
-                        point_on_line2 = XYZ(seg2[0].X + d1[0] * offset2, seg2[0].Y + d1[1] * offset2, seg2[0].Z)
-                        mid_point = XYZ((point_on_line1.X + point_on_line2.X) / 2.0,
-                                        (point_on_line1.Y + point_on_line2.Y) / 2.0,
-                                        (point_on_line1.Z + point_on_line2.Z) / 2.0)
-                        angle = math.atan2(d1[1], d1[0])
-                        angle = snap_angle(angle, tol=0.01)
-                        candidate_data = (mid_point, angle, overlap_length, wall_fam)
-                        break
-                if candidate_data:
-                    placements.append(candidate_data)
+                    seg1, seg2 = heapq.nlargest(2, [segments[k] for k in group], key=lambda s: s[3])
+                    candidate_data = match_structural_pair(seg1, seg2, width_to_family)
+                    if candidate_data:
+                        add_placement(candidate_data)
     elif architectural_mode:
         for element in lines_data:
             if element["type"].lower() not in ["polyline", "mline", "multiline"]:
@@ -637,149 +929,75 @@ def on_ok_button_click(sender, e):
             if len(pts) < 2:
                 continue
 
-            # Create segments for the polyline
-            segments = []
-            for i in range(len(pts) - 1):
-                p_start = pts[i]
-                p_end = pts[i + 1]
-                d = segment_direction(p_start, p_end)
-                seg_length = math.sqrt((p_end.X - p_start.X) ** 2 + (p_end.Y - p_start.Y) ** 2)
-                segments.append({
-                    'start': p_start,
-                    'end': p_end,
-                    'direction': d,
-                    'length': seg_length,
-                    'used': False  # Track if segment has been used
-                })
-
-            gap_tol = 0.1
-            angle_tol = 0.1
+            # Merge consecutive collinear segments, tracking only the first vertex
+            # and the accumulated chord of the current run. Consecutive polyline
+            # segments share a vertex, so there is never a gap between them.
+            coords = polyline_coords(pts)
+            seg_dxs, seg_dys, seg_lengths, _ = polyline_segments(coords)
             merged_segments = []
-            last_gap = None  # To store gap from a break
-
-            if segments:
-                current_seg = segments[0]
-                for seg in segments[1:]:
-                    angle_diff = math.atan2(current_seg['direction'][1], current_seg['direction'][0]) - \
-                                 math.atan2(seg['direction'][1], seg['direction'][0])
-                    angle_diff = abs(angle_diff % math.pi)
-                    is_collinear = angle_diff < angle_tol or abs(angle_diff - math.pi) < angle_tol
+            if seg_dxs:
+                cur_start = 0
+                cur_dx = seg_dxs[0]
+                cur_dy = seg_dys[0]
+                for i in range(1, len(seg_dxs)):
+                    # Parallel or anti-parallel within 0.1 rad: |cos| >= cos(0.1)
+                    dot = cur_dx * seg_dxs[i] + cur_dy * seg_dys[i]
+                    bound = MERGE_COS_TOL * seg_lengths[i]
+                    is_collinear = dot * dot >= bound * bound * (cur_dx * cur_dx + cur_dy * cur_dy)
 
                     if is_collinear:
-                        gap = math.sqrt((seg['start'].X - current_seg['end'].X) ** 2 +
-                                        (seg['start'].Y - current_seg['end'].Y) ** 2)
-                        if gap < gap_tol:
-                            # Merge segments with a small gap
-                            new_start = current_seg['start']
-                            new_end = seg['end']
-                            new_length = math.sqrt((new_end.X - new_start.X) ** 2 +
-                                                   (new_end.Y - new_start.Y) ** 2)
-                            new_direction = segment_direction(new_start, new_end)
-                            current_seg = {
-                                'start': new_start,
-                                'end': new_end,
-                                'direction': new_direction,
-                                'length': new_length,
-                                'used': False
-                            }
-                            last_gap = None
-                            continue
-                        # Allow merging if the gap is consistent with a previous break
-                        elif last_gap is not None and abs(gap - last_gap) < gap_tol:
-                            new_start = current_seg['start']
-                            new_end = seg['end']
-                            new_length = math.sqrt((new_end.X - new_start.X) ** 2 +
-                                                   (new_end.Y - new_start.Y) ** 2)
-                            new_direction = segment_direction(new_start, new_end)
-                            current_seg = {
-                                'start': new_start,
-                                'end': new_end,
-                                'direction': new_direction,
-                                'length': new_length,
-                                'used': False
-                            }
-                            continue
-                        else:
-                            # Not mergeable; store gap and push current segment as a continuous block
-                            last_gap = gap
-                            merged_segments.append(current_seg)
-                            current_seg = seg
-                    else:
-                        last_gap = None
-                        merged_segments.append(current_seg)
-                        current_seg = seg
-                merged_segments.append(current_seg)
-            else:
-                merged_segments = segments
-
-            # Group merged segments by their direction
+                        cur_dx += seg_dxs[i]
+                        cur_dy += seg_dys[i]
+                        continue
+                    merged_segments.append(make_segment(coords[cur_start], coords[i], cur_dx, cur_dy))
+                    cur_start = i
+                    cur_dx = seg_dxs[i]
+                    cur_dy = seg_dys[i]
+                merged_segments.append(make_segment(coords[cur_start], coords[len(seg_dxs)], cur_dx, cur_dy))
+
+            # Group merged segments by their direction, each group anchored on
+            # its first angle in polyline order, and visit groups in that order
             angle_tolerance = 0.1
-            direction_groups = {}
-            for seg in merged_segments:
-                angle = math.atan2(seg['direction'][1], seg['direction'][0]) % math.pi
-                matched = False
-                for group_angle in list(direction_groups.keys()):
-                    if abs(group_angle - angle) < angle_tolerance or \
-                            abs(group_angle - angle + math.pi) < angle_tolerance or \
-                            abs(group_angle - angle - math.pi) < angle_tolerance:
-                        direction_groups[group_angle].append(seg)
-                        matched = True
-                        break
-                if not matched:
-                    direction_groups[angle] = [seg]
+            seg_angles = [math.atan2(seg['direction'][1], seg['direction'][0]) % math.pi
+                          for seg in merged_segments]
+            direction_groups = group_by_angle(seg_angles, angle_tolerance)
 
             # Sort segments within each group by their position along the direction
-            for group_angle, seg_group in direction_groups.items():
+            for group in direction_groups:
+                seg_group = [merged_segments[k] for k in group]
                 if len(seg_group) == 1:
                     # For single segments, try to match with wall family widths
                     seg = seg_group[0]
                     if seg['used']:
                         continue
 
-                    mid_point = XYZ((seg['start'].X + seg['end'].X) / 2,
-                                    (seg['start'].Y + seg['end'].Y) / 2,
-                                    (seg['start'].Z + seg['end'].Z) / 2)
-                    wall_angle = math.atan2(seg['direction'][1], seg['direction'][0])
-
-                    # Check if there's already a wall at this location
-                    location_used = False
-                    for existing in placements:
-                        if existing[0].DistanceTo(mid_point) < 0.01:  # 0.01 feet tolerance
-                            location_used = True
-                            break
+                    mx = (seg['start'][0] + seg['end'][0]) / 2
+                    my = (seg['start'][1] + seg['end'][1]) / 2
+                    mz = (seg['start'][2] + seg['end'][2]) / 2
 
-                    if location_used:
+                    # Check if there's already a wall at this location (0.01 feet tolerance)
+                    if grid_has_point(placement_grid, mx, my, mz, tol=0.01):
                         continue
 
+                    wall_angle = math.atan2(seg['direction'][1], seg['direction'][0])
+
                     # Try to match segment length with wall family widths
                     seg_length_mm = int(round(seg['length'] * 304.8))
-                    matching_wall = None
-                    for wall_fam in selected_families:
-                        extracted_ints = [int(x) for x in re.findall(r'\d+', wall_fam) if int(x) > 10]
-                        if not extracted_ints:
-                            continue
-                        desired_width = extracted_ints[0]
-                        if abs(seg_length_mm - desired_width) <= 0.5:
-                            matching_wall = wall_fam
-                            break
-
-                    if matching_wall:
-                        placements.append((mid_point, wall_angle, seg['length'], matching_wall))
-                        seg['used'] = True
-                    else:
-                        placements.append((mid_point, wall_angle, seg['length'], selected_families[0]))
-                        seg['used'] = True
-
-                elif len(seg_group) >= 2:
+                    matching_wall = match_family_width(width_to_family, seg_length_mm, selected_families[0])
+                    add_placement((mx, my, mz, wall_angle, seg['length'], matching_wall))
+                    seg['used'] = True
+
+                elif len(seg_group) >= 2 and width_to_family:
                     # Sort segments by length
                     sorted_segs = sorted(seg_group, key=lambda x: x['length'], reverse=True)
+                    candidates = pair_candidates(sorted_segs, min_width_mm, max_width_mm)
 
                     # Process each pair of segments
                     for i in range(len(sorted_segs)):
                         if sorted_segs[i]['used']:
                             continue
 
-                        for j in range(i + 1, len(sorted_segs)):
+                        for j in candidates[i]:
                             if sorted_segs[j]['used']:
                                 continue
 
@@ -790,120 +1008,75 @@ def on_ok_button_click(sender, e):
                             if seg1['used'] or seg2['used']:
                                 continue
 
-                            # Calculate perpendicular distance between segments
-                            dir_vec = seg1['direction']
-                            perp_vec = (-dir_vec[1], dir_vec[0])
-
-                            # Project points onto perpendicular direction
-                            def project_point(p):
-                                return p.X * perp_vec[0] + p.Y * perp_vec[1]
-
                             # Find the longer segment
                             longer_seg = seg1 if seg1['length'] > seg2['length'] else seg2
                             shorter_seg = seg2 if seg1['length'] > seg2['length'] else seg1
-
-                            # Calculate midpoint of longer segment
-                            longer_mid = XYZ((longer_seg['start'].X + longer_seg['end'].X) / 2,
-                                             (longer_seg['start'].Y + longer_seg['end'].Y) / 2,
-                                             (longer_seg['start'].Z + longer_seg['end'].Z) / 2)
-
-                            # Project longer segment's midpoint onto shorter segment
-                            # Calculate vector from shorter segment start to longer midpoint
-                            vec_to_mid = XYZ(longer_mid.X - shorter_seg['start'].X,
-                                             longer_mid.Y - shorter_seg['start'].Y,
-                                             0)
-
-                            # Project this vector onto the direction of shorter segment
-                            dir_dot = vec_to_mid.X * dir_vec[0] + vec_to_mid.Y * dir_vec[1]
-                            proj_vec = XYZ(dir_dot * dir_vec[0], dir_dot * dir_vec[1], 0)
-
-                            # Calculate projected point on shorter segment
-                            proj_point = XYZ(shorter_seg['start'].X + proj_vec.X,
-                                             shorter_seg['start'].Y + proj_vec.Y,
-                                             shorter_seg['start'].Z)
-
-                            # Calculate true midpoint between parallel lines
-                            mid_point = XYZ((longer_mid.X + proj_point.X) / 2,
-                                            (longer_mid.Y + proj_point.Y) / 2,
-                                            (longer_mid.Z + proj_point.Z) / 2)
-
-                            # Calculate wall length as the distance between parallel lines
-                            distance = abs(project_point(longer_mid) - project_point(proj_point))
+                            ls, le, ss = longer_seg['start'], longer_seg['end'], shorter_seg['start']
+                            mx, my, mz, distance = parallel_pair_midpoint(
+                                ls[0], ls[1], ls[2], le[0], le[1], le[2], ss[0], ss[1], ss[2],
+                                seg1['direction'][0], seg1['direction'][1])
                             distance_mm = int(round(distance * 304.8))
 
-                            # Check if there's already a wall at this location
-                            location_used = False
-                            for existing in placements:
-                                if existing[0].DistanceTo(mid_point) < 0.01:  # 0.01 feet tolerance
-                                    location_used = True
-                                    break
+                            # Try to match distance with wall family widths
+                            matching_wall = match_family_width(width_to_family, distance_mm)
+                            if not matching_wall:
+                                continue
 
-                            if location_used:
+                            # Check if there's already a wall at this location (0.01 feet tolerance)
+                            if grid_has_point(placement_grid, mx, my, mz, tol=0.01):
                                 continue
 
-                            # Try to match distance with wall family widths
-                            matching_wall = None
-                            for wall_fam in selected_families:
-                                extracted_ints = [int(x) for x in re.findall(r'\d+', wall_fam) if int(x) > 10]
-                                if not extracted_ints:
-                                    continue
-                                desired_width = extracted_ints[0]
-                                if abs(distance_mm - desired_width) <= 0.5:
-                                    matching_wall = wall_fam
-                                    break
-
-                            if matching_wall:
-                                # Use the direction of the longer segment for wall angle
-                                wall_angle = math.atan2(longer_seg['direction'][1], longer_seg['direction'][0])
-
-                                # Normalize angle to ensure consistent direction
-                                angle_mod = wall_angle % math.pi
-                                if angle_mod > math.pi / 2:
-                                    wall_angle = wall_angle - math.pi
-
-                                # Create wall placement with the calculated midpoint and angle
-                                # Use the length of the longer segment for wall length
-                                placements.append((mid_point, wall_angle, longer_seg['length'], matching_wall))
-
-                                # Mark both segments as used immediately after creating the wall
-                                seg1['used'] = True
-                                seg2['used'] = True
-                                break  # Break inner loop since we found a match for seg1
+                            # Use the direction of the longer segment for wall angle
+                            wall_angle = math.atan2(longer_seg['direction'][1], longer_seg['direction'][0])
+
+                            # Normalize angle to ensure consistent direction
+                            angle_mod = wall_angle % math.pi
+                            if angle_mod > math.pi / 2:
+                                wall_angle = wall_angle - math.pi
+
+                            # Create wall placement with the calculated midpoint and angle
+                            # Use the length of the longer segment for wall length
+                            add_placement((mx, my, mz, wall_angle, longer_seg['length'], matching_wall))
+
+                            # Mark both segments as used immediately after creating the wall
+                            seg1['used'] = True
+                            seg2['used'] = True
+                            break  # Break inner loop since we found a match for seg1
 
                         if sorted_segs[i]['used']:
                             break  # Break outer loop if current segment was used
 
     # Deduplicate placements
+    # One XY grid per (wall family, 0.01 rad angle cell); a duplicate can only
+    # sit in the same family and the neighbouring angle cells.
     deduped_placements = []
+    deduped_grids = {}
     for candidate in placements:
+        cx, cy, cz, c_angle, _, c_fam = candidate
+        ca = int(math.floor(c_angle / 0.01))
         duplicate = False
-        for existing in deduped_placements:
-            if (candidate[0].DistanceTo(existing[0]) < 0.01 and
-                    abs(candidate[1] - existing[1]) < 0.01 and
-                    candidate[3] == existing[3]):
-                duplicate = True
+        for a in (ca - 1, ca, ca + 1):
+            for ex, ey, ez, existing in grid_near(deduped_grids.get((c_fam, a), {}), cx, cy):
+                if _d2(ex, ey, ez, cx, cy, cz) < 0.0001 and abs(c_angle - existing[3]) < 0.01:
+                    duplicate = True
+                    break
+            if duplicate:
                 break
         if not duplicate:
             deduped_placements.append(candidate)
+            grid_add(deduped_grids.setdefault((c_fam, ca), {}), cx, cy, cz, candidate)
     placements = deduped_placements
 
-    # Sort placements by position to ensure consistent order
-    def get_placement_position(placement):
-        return placement[0].X * math.cos(placement[1]) + placement[0].Y * math.sin(placement[1])
-
-    placements.sort(key=get_placement_position)
-
-    bottom_elev = None
-    top_elev = None
-    for lvl in levels:
-        if lvl.Name == bottom_level_name:
-            bottom_elev = lvl.Elevation
-        if lvl.Name == top_level_name:
-            top_elev = lvl.Elevation
-    if bottom_elev is None:
-        bottom_elev = 0
-    if top_elev is None:
-        top_elev = 0
+    # Sort placements by position to ensure consistent order. The unit
+    # directions are computed once and kept aligned with the sorted list.
+    placement_dirs = [(math.cos(p[3]), math.sin(p[3])) for p in placements]
+    positions = [p[0] * c + p[1] * s for p, (c, s) in zip(placements, placement_dirs)]
+    order = sorted(range(len(placements)), key=positions.__getitem__)
+    placements = [placements[k] for k in order]
+    placement_dirs = [placement_dirs[k] for k in order]
+
+    bottom_elev = _lvl_elev.get(bottom_level_name, 0)
+    top_elev = _lvl_elev.get(top_level_name, 0)
     level_distance = abs(top_elev - bottom_elev)
     total_wall_count = len(placements)
 
@@ -923,6 +1096,8 @@ def on_ok_button_click(sender, e):
     progress_window.Show()
 
     current = 0
+    # Refresh the progress UI (and pump messages for Cancel) about every 1%
+    update_every = max(1, total_wall_count // 100)
     created_walls = []
     try:
         t_place = Transaction(doc, "Place Walls")
@@ -930,68 +1105,58 @@ def on_ok_button_click(sender, e):
     except Exception:
         return
 
-    unique_fams = set([wf for (_, _, _, wf) in placements])
+    unique_fams = set([p[5] for p in placements])
+    fs_by_fam = {}
     for wf in unique_fams:
-        fs_temp = find_family_symbol(wf)
-        if fs_temp and hasattr(fs_temp, "IsActive") and not fs_temp.IsActive:
+        fs = find_family_symbol(wf)
+        if fs is not None:
+            fs_by_fam[wf] = fs
+    # Activate inside the already open "Place Walls" transaction and
+    # regenerate once for all of them before any wall reads a type.
+    to_activate = [fs for fs in fs_by_fam.values()
+                   if hasattr(fs, "IsActive") and not fs.IsActive]
+    if to_activate:
+        for fs in to_activate:
             try:
-                t_activate = Transaction(doc, "Activate Wall Family")
-                t_activate.Start()
-                fs_temp.Activate()
-                doc.Regenerate()
-                t_activate.Commit()
+                fs.Activate()
             except Exception:
                 pass
-
-    topLevel = doc.GetElement(find_level_by_name(top_level_name).Id) if find_level_by_name(top_level_name) else None
-    baseLevel = doc.GetElement(find_level_by_name(bottom_level_name).Id) if find_level_by_name(
-        bottom_level_name) else None
-
-    for (pt, angle, wall_length, wall_fam) in placements:
+        doc.Regenerate()
+
+    index_existing_walls()
+    # Wall.Create and the constraint parameters only need ElementIds
+    fs_id_cache = {wf: fs.Id for wf, fs in fs_by_fam.items()}
+    top_lvl = find_level_by_name(top_level_name)
+    base_lvl = find_level_by_name(bottom_level_name)
+    top_level_id = top_lvl.Id if top_lvl else None
+    base_level_id = base_lvl.Id if base_lvl else None
+    level_id = base_level_id if base_level_id is not None else levels[0].Id
+    short_tol = doc.Application.ShortCurveTolerance
+    base_offset_ft = base_offset / 304.8
+    top_offset_ft = top_offset / 304.8
+    wall_height = level_distance + top_offset_ft - base_offset_ft
+
+    for (px, py, pz, angle, wall_length, wall_fam), (cos_a, sin_a) in zip(placements, placement_dirs):
         if cancelled[0]:
             break
-        fs = find_family_symbol(wall_fam)
-        if fs is None:
+        fs_id = fs_id_cache.get(wall_fam)
+        if fs_id is None:
             continue
-        fs = doc.GetElement(fs.Id)
-        if wall_length < doc.Application.ShortCurveTolerance:
+        if wall_length < short_tol:
             continue
-        direction_vector = XYZ(math.cos(angle), math.sin(angle), 0)
-        start_pt = XYZ(pt.X - (wall_length / 2) * direction_vector.X,
-                       pt.Y - (wall_length / 2) * direction_vector.Y,
-                       pt.Z)
-        end_pt = XYZ(pt.X + (wall_length / 2) * direction_vector.X,
-                     pt.Y + (wall_length / 2) * direction_vector.Y,
-                     pt.Z)
+        hx = (wall_length / 2) * cos_a
+        hy = (wall_length / 2) * sin_a
+        start_pt = XYZ(px - hx, py - hy, pz)
+        end_pt = XYZ(px + hx, py + hy, pz)
         try:
             wall_line = DB.Line.CreateBound(start_pt, end_pt)
-            actual_dir = XYZ(end_pt.X - start_pt.X, end_pt.Y - start_pt.Y, end_pt.Z - start_pt.Z)
-            dot_dir = actual_dir.X * direction_vector.X + actual_dir.Y * direction_vector.Y
-            if dot_dir < 0:
-                start_pt, end_pt = end_pt, start_pt
-                wall_line = DB.Line.CreateBound(start_pt, end_pt)
         except Exception:
             continue
-        if wall_line.Length < doc.Application.ShortCurveTolerance:
-            continue
-        duplicate = False
-        for (existing_wall, existing_line) in created_walls:
-            if (wall_line.GetEndPoint(0).DistanceTo(existing_line.GetEndPoint(0)) < 0.005 and
-                    wall_line.GetEndPoint(1).DistanceTo(existing_line.GetEndPoint(1)) < 0.005):
-                duplicate = True
-                break
-        if not duplicate and wall_exists(wall_line, tol=0.005):
-            duplicate = True
-        if duplicate:
+        # Walls created in this run are added to the same endpoint index
+        if wall_exists(wall_line, tol=0.005):
             continue
-        level = find_level_by_name(bottom_level_name)
-        if level is None:
-            level = levels[0]
-        level = doc.GetElement(level.Id)
-        base_offset_ft = base_offset / 304.8
-        wall_height = level_distance + (top_offset / 304.8) - base_offset_ft
         try:
-            new_wall = Wall.Create(doc, wall_line, fs.Id, level.Id, wall_height, base_offset_ft, False, False)
+            new_wall = Wall.Create(doc, wall_line, fs_id, level_id, wall_height, base_offset_ft, False, False)
         except Exception:
             continue
         try:
@@ -1000,44 +1165,38 @@ def on_ok_button_click(sender, e):
         except Exception:
             pass
         created_walls.append((new_wall, wall_line))
+        add_wall_endpoints(wall_line)
+        current += 1
+        # Cancel closes the progress window, so stop writing to it
+        if not cancelled[0] and (current % update_every == 0 or current == total_wall_count):
+            txtProgress.Text = "Walls Created: {0} / {1}".format(current, total_wall_count)
+            pb.Value = float(current)
+            WinForms.Application.DoEvents()
+
+    # Wall.Create already set the base level and base offset; only the top
+    # constraint is left.
+    for (new_wall, _) in created_walls:
         try:
-            if baseLevel is not None:
-                param_base = new_wall.get_Parameter(BuiltInParameter.WALL_BASE_CONSTRAINT)
-                if param_base:
-                    param_base.Set(baseLevel.Id)
-            if topLevel is not None:
+            if top_level_id is not None:
                 param_top = new_wall.get_Parameter(BuiltInParameter.WALL_HEIGHT_TYPE)
                 if param_top:
-                    param_top.Set(topLevel.Id)
+                    param_top.Set(top_level_id)
         except Exception:
             pass
         try:
-            param_base_offset = new_wall.get_Parameter(BuiltInParameter.WALL_BASE_OFFSET)
-            if param_base_offset:
-                param_base_offset.Set(base_offset_ft)
             param_top_offset = new_wall.get_Parameter(BuiltInParameter.WALL_TOP_OFFSET)
             if param_top_offset:
-                param_top_offset.Set(top_offset / 304.8)
+                param_top_offset.Set(top_offset_ft)
         except Exception:
             pass
-        current += 1
-        txtProgress.Text = "Walls Created: {0} / {1}".format(current, total_wall_count)
-        pb.Value = float(current)
-        WinForms.Application.DoEvents()
-
     try:
+        doc.Regenerate()
         t_place.Commit()
     except Exception:
         try:
             t_place.RollBack()
         except Exception:
             pass
-    try:
-        t_final = Transaction(doc, "Finalize")
-        t_final.Start()
-        t_final.Commit()
-    except Exception:
-        pass
     progress_window.Close()
 
 